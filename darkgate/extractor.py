@@ -1,10 +1,17 @@
 import argparse
 import base64
 import binascii
+import concurrent.futures
+import contextlib
+import functools
 import json
 import logging
 import magic
+import mmap
+import operator
+import os
 import re
+import shutil
 import subprocess
 import tempfile
 import zlib
@@ -16,45 +23,64 @@ CONFIG_ALPHABET_REGEX = re.compile(
     + CONFIG_ALPHABET_SPACER
     + rb"([^\0]{64})\0{4}"
 )
+# Default number of bytes inspected by libmagic (MAGIC_PARAM_BYTES_MAX)
+MAGIC_BUFFER_SIZE = 7 * 1024 * 1024
+BIN_7Z = shutil.which("7z")
 PE_START_BYTES = bytes.fromhex("4D5A50000200000004000F00FFFF00")
 AU3_MAGIC_BYTES = b"AU3!EA06"
 PE_CHARACTERISTIC_STRING = b"__padoru__"
-REGEX_CONFIG_CANDIDATES = rb"[A-Za-z0-9+/=]{10,}"
+AU3_B64_ALPHABET_CHARS = frozenset(
+    b"+0123456789=ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+)
+CONFIG_CANDIDATES_REGEX = re.compile(rb"[A-Za-z0-9+/=]{10,}")
+CONFIG_FLAG_REGEX = re.compile(r"(\d+)=(\w+)")
+C2_URL_REGEX = re.compile(rb"^https?://")
 
 
 # =====================================================================
-# Custom base64 decoding as implemented by rivitna:
+# Custom base64 decoding, compatible with the decoder by rivitna:
 # https://github.com/rivitna/Malware2/blob/main/DarkGate/dg_dec_data.py
-def base64_decode_block(block, encode_table):
-    if len(block) < 2:
-        raise ValueError("Base64 decode error.")
-    n = 0
-    for i in range(4):
-        n <<= 6
-        if i < len(block):
-            b = encode_table.find(block[i])
-            if b < 0:
-                raise ValueError("Base64 invalid char (%02X)." % block[i])
-            n |= b
+# The custom alphabet is mapped onto the standard one so that the actual
+# decoding is done by the C implementation in the standard library.
+STANDARD_B64_ALPHABET = (
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+)
+
 
-    dec_block = bytes([(n >> 16) & 0xFF, (n >> 8) & 0xFF])
-    if len(block) >= 4:
-        dec_block += bytes([n & 0xFF])
+@functools.lru_cache(maxsize=None)
+def base64_translation_table(encode_table: bytes) -> bytes:
+    # Reversed, so that the first occurrence of a duplicate char takes precedence
+    return bytes.maketrans(encode_table[::-1], STANDARD_B64_ALPHABET[::-1])
 
-    return dec_block
 
+def base64_decodable(data, encode_table) -> bool:
+    return len(data) % 4 != 1 and not data.translate(None, encode_table)
 
-def base64_decode(data, encode_table):
-    dec_data = b""
-    for block in (data[i : i + 4] for i in range(0, len(data), 4)):
-        dec_data += base64_decode_block(block, encode_table)
 
-    return dec_data
+def base64_decode(data, encode_table, validate=True):
+    # Callers that already ran base64_decodable can skip the char check
+    if validate and data.translate(None, encode_table):
+        raise binascii.Error("Base64 invalid char.")
+    data = data.translate(base64_translation_table(encode_table))
+    remainder = len(data) % 4
+    if remainder == 1:
+        raise binascii.Error("Base64 decode error.")
+    elif remainder == 2:
+        # A trailing block of two chars yields two bytes in DarkGate's decoder
+        data += b"A="
+    elif remainder == 3:
+        data += b"="
+    return base64.b64decode(data, validate=True)
 
 
 # =====================================================================
 
 
+@functools.lru_cache(maxsize=256)
+def xor_translation_table(xor_key: int) -> bytes:
+    return bytes(b ^ xor_key for b in range(256))
+
+
 class DarkGateUnpacker:
     def __init__(self, payload: bytes):
         self.payload = payload
@@ -66,22 +92,17 @@ class DarkGateUnpacker:
 class DarkGateAU3Unpacker(DarkGateUnpacker):
     def _decrypt_payload(self, payload: bytes, xor_key: int) -> bytes:
         decoded = base64.b64decode(payload)
-        decrypted = bytes(b ^ xor_key for b in decoded)
+        decrypted = decoded.translate(xor_translation_table(xor_key))
         return decrypted
 
     def _unpack_au3_payload_legacy(self) -> bytes:
         try:
             splitted = self.payload.split(b"|")
-            xor_key = "a" + splitted[1][1:9].decode()
-            final_xor_key = len(xor_key)
-            for char in xor_key:
-                final_xor_key ^= ord(char)
-            final_xor_key = ~final_xor_key
+            xor_key = b"a" + splitted[1][1:9]
+            final_xor_key = ~functools.reduce(operator.xor, xor_key, len(xor_key))
             final_xor_key &= 255
             payload = self._decrypt_payload(splitted[2], final_xor_key)
             return payload
-        except UnicodeDecodeError:
-            return None
         except binascii.Error:
             return None
 
@@ -89,12 +110,7 @@ class DarkGateAU3Unpacker(DarkGateUnpacker):
         try:
             splitted = self.payload.split(b"|")
             key = splitted[1]
-            sorted_key = bytes(sorted(key))
-            if (
-                len(splitted[1]) != 64
-                or sorted_key
-                != b"+0123456789=ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-            ):
+            if len(key) != 64 or frozenset(key) != AU3_B64_ALPHABET_CHARS:
                 logging.info("No usable custom base64 alphabet found in AU3 file.")
                 return None
             else:
@@ -118,42 +134,47 @@ class DarkGateAU3Unpacker(DarkGateUnpacker):
         return None
 
 
-class DarkGateMSIUnpacker(DarkGateUnpacker):
+class DarkGate7zUnpacker(DarkGateUnpacker):
+    archive_type = None
+    archive_member = None
+
     def unpack(self) -> bytes:
+        if not BIN_7Z:
+            logging.error(f"Unpacking of {self.archive_type} file failed: 7z not found")
+            return None
+        # 7z needs a seekable archive, but the extracted member is read from
+        # stdout, so a single temporary file is used per unpacking step
         with tempfile.NamedTemporaryFile("wb") as f:
             f.write(self.payload)
             f.flush()
             try:
-                bin_7z = subprocess.check_output(["which", "7z"]).decode().strip()
                 return subprocess.check_output(
-                    [bin_7z, "e", "-so", f.name, "Binary.bz.WrappedSetupProgram"]
+                    [BIN_7Z, "e", "-so", f.name, self.archive_member]
                 )
-
             except subprocess.CalledProcessError:
-                logging.error("Unpacking of MSI file failed")
+                logging.error(f"Unpacking of {self.archive_type} file failed")
                 return None
 
 
-class DarkGateCABUnpacker(DarkGateUnpacker):
-    def unpack(self) -> bytes:
-        with tempfile.NamedTemporaryFile("wb") as f:
-            f.write(self.payload)
-            f.flush()
-            try:
-                bin_7z = subprocess.check_output(["which", "7z"]).decode().strip()
-                return subprocess.check_output(
-                    f'{bin_7z} e -so {f.name} "*.au3"', shell=True
-                )
-            except subprocess.CalledProcessError:
-                logging.error("Unpacking of CAB file failed")
-                return None
+class DarkGateMSIUnpacker(DarkGate7zUnpacker):
+    archive_type = "MSI"
+    archive_member = "Binary.bz.WrappedSetupProgram"
+
+
+class DarkGateCABUnpacker(DarkGate7zUnpacker):
+    archive_type = "CAB"
+    archive_member = "*.au3"
 
 
 class DarkGateRecursiveUnpacker(DarkGateUnpacker):
     def unpack(self) -> bytes:
         continue_unpacking = True
         while continue_unpacking:
-            mime_type = magic.from_buffer(self.payload, mime=True)
+            magic_buffer = self.payload
+            if isinstance(magic_buffer, mmap.mmap):
+                # libmagic needs bytes and only inspects the start of a buffer
+                magic_buffer = magic_buffer[:MAGIC_BUFFER_SIZE]
+            mime_type = magic.from_buffer(magic_buffer, mime=True)
             if "application/x-msi" in mime_type:
                 logging.info(f"Found MSI payload. Trying to unpack.")
                 self.payload = DarkGateMSIUnpacker(self.payload).unpack()
@@ -162,13 +183,17 @@ class DarkGateRecursiveUnpacker(DarkGateUnpacker):
                 logging.info(f"Found CAB payload. Trying to unpack.")
                 self.payload = DarkGateCABUnpacker(self.payload).unpack()
                 continue_unpacking = self.payload is not None
-            elif "text/plain" in mime_type and AU3_MAGIC_BYTES in self.payload:
+            elif (
+                "text/plain" in mime_type
+                and self.payload.find(AU3_MAGIC_BYTES) != -1
+            ):
                 logging.info(f"Found AU3 payload. Trying to unpack.")
-                self.payload = DarkGateAU3Unpacker(self.payload).unpack()
+                # The AU3 unpacker splits the payload, which a mmap cannot do
+                self.payload = DarkGateAU3Unpacker(bytes(self.payload)).unpack()
                 continue_unpacking = self.payload is not None
             elif (
                 "application/vnd.microsoft.portable-executable" in mime_type
-                and self.payload.startswith(PE_START_BYTES)
+                and self.payload[: len(PE_START_BYTES)] == PE_START_BYTES
             ):
                 logging.info(f"Found PE file. Unpacking finished")
                 return self.payload
@@ -178,8 +203,9 @@ class DarkGateRecursiveUnpacker(DarkGateUnpacker):
 
 
 class DarkGateConfigExtractor:
-    def __init__(self, payload: bytes):
+    def __init__(self, payload: bytes, include_strings: bool = True):
         self.payload = payload
+        self.include_strings = include_strings
         self.result = {}
         self.config_flag_mapping = {
             "0": "c2_port",
@@ -217,22 +243,20 @@ class DarkGateConfigExtractor:
 
     def _decode_strings(self, alphabet: bytes):
         result = []
-        string_candidates = re.findall(
+        string_candidates = re.finditer(
             rb"[" + re.escape(bytes(sorted(alphabet))) + rb"]{5,}", self.payload
         )
-        for s in string_candidates:
-            try:
-                # Try to decode each string candidate with each alphabet candidate
-                decoded = base64_decode(s, alphabet).decode()
-                decoded_length = len(decoded)
-                ascii_length = len(decoded.encode("ascii", "ignore"))
-                # Rather simple check to sort out garbage strings
-                if decoded_length == ascii_length:
-                    result.append(decoded)
-            except UnicodeDecodeError:
-                pass
-            except ValueError:
-                pass
+        for string_match in string_candidates:
+            s = string_match.group()
+            # The alphabet is taken from the configuration, so there is
+            # exactly one alphabet to try per string candidate. Candidates
+            # only consist of alphabet chars, so only the length can be wrong.
+            if len(s) % 4 == 1:
+                continue
+            decoded = base64_decode(s, alphabet, validate=False)
+            # Rather simple check to sort out garbage strings
+            if decoded.isascii():
+                result.append(decoded.decode())
         self.result["strings"] = result
 
     def _parse_config_value(self, value: str) -> bool | int | str:
@@ -246,7 +270,7 @@ class DarkGateConfigExtractor:
             return value
 
     def _parse_config_string(self, value: str):
-        for item in re.findall(r"(\d+)=(\w+)", value):
+        for item in CONFIG_FLAG_REGEX.findall(value):
             if item[0] in self.config_flag_mapping:
                 self.result[
                     self.config_flag_mapping[item[0]]
@@ -261,19 +285,22 @@ class DarkGateConfigExtractor:
             self.result["c2_servers"] = split_string
 
     def _decode_config(self, alphabet: bytes):
-        for match in re.findall(REGEX_CONFIG_CANDIDATES, self.payload):
+        for config_match in CONFIG_CANDIDATES_REGEX.finditer(self.payload):
+            match = config_match.group()
+            if not base64_decodable(match, alphabet):
+                continue
             try:
-                decoded = base64_decode(match, alphabet)
-                if re.match(rb"^https?:\/\/", decoded):
+                decoded = base64_decode(match, alphabet, validate=False)
+                if C2_URL_REGEX.match(decoded):
                     self._parse_c2_string(decoded.decode())
                     continue
                 elif b"1=Yes" in decoded or b"1=No" in decoded:
                     self._parse_config_string(decoded.decode())
                     continue
                 else:
-                    inflated = zlib.decompress(decoded).decode()
-                    if "1=Yes" in inflated or "1=No" in inflated:
-                        self._parse_config_string(inflated)
+                    inflated = zlib.decompress(decoded)
+                    if b"1=Yes" in inflated or b"1=No" in inflated:
+                        self._parse_config_string(inflated.decode())
             except zlib.error:
                 pass
             except ValueError:
@@ -281,16 +308,56 @@ class DarkGateConfigExtractor:
 
     def extract(self) -> dict:
         string_alphabet, config_alphabet = self._get_config_alphabets()
-        if string_alphabet:
+        # Decrypted strings are not needed for the configuration itself
+        if string_alphabet and self.include_strings:
             self._decode_strings(string_alphabet)
         if config_alphabet:
             self._decode_config(config_alphabet)
         return self.result
 
 
+def analyze_file(filename: str, include_strings: bool = False) -> dict:
+    with open(filename, "rb") as f:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            mapping = contextlib.nullcontext(b"")
+        with mapping as content:
+            result = DarkGateRecursiveUnpacker(content).unpack()
+            if not result:
+                logging.error(f"Could not find any usable payload in {filename}.")
+                return None
+            config_result = DarkGateConfigExtractor(result, include_strings).extract()
+            if not config_result:
+                logging.error(f"Failed to extract configuration from {filename}.")
+                return None
+            return config_result
+
+
+def analyze_file_in_batch(filename: str, include_strings: bool = False) -> dict:
+    # A single malformed sample must not abort the whole batch
+    try:
+        return analyze_file(filename, include_strings)
+    except Exception:
+        logging.exception(f"Analysis of {filename} failed.")
+        return None
+
+
+def configure_logging(level: int):
+    logging.basicConfig(format="[%(levelname)s] %(message)s", level=level)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("file")
+    parser.add_argument("file", nargs="?")
+    parser.add_argument(
+        "-b",
+        "--batch",
+        required=False,
+        metavar="DIR",
+        help="Analyze all files in a directory in parallel",
+    )
     parser.add_argument(
         "-s",
         "--strings",
@@ -306,21 +373,29 @@ if __name__ == "__main__":
         help="Provide debug log output",
     )
     args = parser.parse_args()
+    if bool(args.file) == bool(args.batch):
+        parser.error("either a file or --batch DIR is required")
     if args.debug:
         level = logging.INFO
     else:
         level = logging.ERROR
-    logging.basicConfig(format="[%(levelname)s] %(message)s", level=level)
+    configure_logging(level)
     logging.info("Starting Telekom Security DarkGate Extractor")
-    with open(args.file, "rb") as f:
-        result = DarkGateRecursiveUnpacker(f.read()).unpack()
-        if result:
-            config_result = DarkGateConfigExtractor(result).extract()
-            if config_result:
-                if not args.strings:
-                    config_result.pop("strings")
-                print(json.dumps(config_result, sort_keys=True, indent=4))
-            else:
-                logging.error("Failed to extract configuration.")
-        else:
-            logging.error("Could not find any usable payload.")
+    if args.batch:
+        filenames = sorted(
+            entry.path for entry in os.scandir(args.batch) if entry.is_file()
+        )
+        # Workers do not inherit the logging setup under the spawn start method
+        with concurrent.futures.ProcessPoolExecutor(
+            initializer=configure_logging, initargs=(level,)
+        ) as executor:
+            results = executor.map(
+                functools.partial(analyze_file_in_batch, include_strings=args.strings),
+                filenames,
+            )
+            batch_result = dict(zip(filenames, results))
+        print(json.dumps(batch_result, sort_keys=True, indent=4))
+    else:
+        config_result = analyze_file(args.file, args.strings)
+        if config_result:
+            print(json.dumps(config_result, sort_keys=True, indent=4))